@@ -38,12 +38,24 @@ nheads = 12
 master_addr = "127.0.0.1"
 master_port = 39266
 
+# NCCL tuning for the socket transport between machines, exported by the entry scripts unless already set in the environment
+nccl_env = {
+    'NCCL_NSOCKS_PERTHREAD': 4,
+    'NCCL_SOCKET_NTHREADS': 2,
+    'NCCL_MIN_NCHANNELS': 4,
+    'NCCL_BUFFSIZE': 8 << 20,
+    # 'NCCL_IB_DISABLE': 0, 'NCCL_IB_HCA': 'mlx5', 'NCCL_P2P_LEVEL': 'NVL', # for DGX-class machines with InfiniBand and NVLink
+}
+
 # segmentation = True
 segmentation = False
 
 # trace = True
 trace = False
 
+# fp16 = True
+fp16 = False
+
 report_per_iter_time = True
 # report_per_iter_time = False
 
@@ -107,17 +119,25 @@ def get_data():
         x = torch.rand(batch_size, seqlen, emsize) / 6
         y = torch.rand(batch_size)
         def rep():
+            pinned_x, pinned_y = x.pin_memory(), y.pin_memory() # pinned lazily, building the model should not require a GPU
             while True:
-                yield x, y
+                yield pinned_x, pinned_y
         return 0, rep()
 
+def pinned(data):
+    # page-locked copies, so that `.to(device, non_blocking=True)` does not block the host. A single host copy, which also
+    # makes the strided wikitext slices contiguous
+    import torch
+    for x, y in data:
+        yield torch.empty(x.shape, dtype=x.dtype, pin_memory=True).copy_(x), torch.empty(y.shape, dtype=y.dtype, pin_memory=True).copy_(y)
+
 def wikitext2():
     sys.path.insert(1, f"{rootpath}/wikitext")
     import data
     corpus = data.Corpus(f"{rootpath}/wikitext")
-    train_data = data.segmentify(data.batchify(corpus.train, batch_size), seqlen)
-    test_data = data.segmentify(data.batchify(corpus.test, batch_size), seqlen)
-    valid_data = data.segmentify(data.batchify(corpus.valid, batch_size), seqlen)
+    train_data = pinned(data.segmentify(data.batchify(corpus.train, batch_size), seqlen))
+    test_data = pinned(data.segmentify(data.batchify(corpus.test, batch_size), seqlen))
+    valid_data = pinned(data.segmentify(data.batchify(corpus.valid, batch_size), seqlen))
     ntokens = world_size * (len(corpus.dictionary) // world_size + 1) # we have to ensure that it is dividable
     return ntokens, train_data, test_data, valid_data
 
@@ -125,7 +145,7 @@ def cifar10():
     import torch
     import torchvision
     def it(data):
-        loader = torch.utils.data.DataLoader(data, batch_size=batch_size, drop_last=True)
+        loader = torch.utils.data.DataLoader(data, batch_size=batch_size, drop_last=True, pin_memory=True)
         while True:
             yield from iter(loader)
     train_data = torchvision.datasets.CIFAR10(f"{rootpath}/cifar10", train=True, transform=torchvision.transforms.ToTensor()) #, download=True
@@ -13,20 +13,42 @@ from torch.nn.parallel import DistributedDataParallel as DDP
 
 from utils import *
 
-def run(global_rank, local_rank):
+def clip_grad_norm_(parameters, max_norm):
+    # torch.nn.utils.clip_grad_norm_ launches a norm kernel per parameter (PyTorch 1.13 has no foreach option for it).
+    # Only the norms are batched: 1.13 has no foreach mul by a tensor scalar, so the rescaling is still one kernel per gradient
+    grads = [ p.grad for p in parameters if p.grad is not None ]
+    if not grads:
+        return torch.zeros(())
+    total_norm = torch.linalg.vector_norm(torch.stack(torch._foreach_norm(grads, 2)))
+    clip_coef = torch.clamp(max_norm / (total_norm + 1e-6), max=1.0) # stays on device, no sync
+    for g in grads:
+        g.mul_(clip_coef)
+    return total_norm
+
+def run(local_rank, ranks):
+    global_rank = ranks[local_rank]
+
+    torch.cuda.set_device(local_rank)
+    if hasattr(torch.cuda.memory, '_set_allocator_settings'): # PyTorch 2.1+; MoE routing changes allocation sizes every step and fragments the cache otherwise
+        torch.cuda.memory._set_allocator_settings("expandable_segments:True")
+
     import torch.distributed as dist
     dist.init_process_group('nccl', rank=global_rank)
 
     model = config.get_model(seed=39).cuda(local_rank)
-    dmodel = DDP(model, device_ids=[local_rank])
+    # gradients live directly in the all-reduce buckets (no copy in and out), fewer and larger buckets mean fewer NCCL calls
+    dmodel = DDP(model, device_ids=[local_rank], gradient_as_bucket_view=True, bucket_cap_mb=100, static_graph=True)
     del model
 
-    optimizer = torch.optim.Adam(dmodel.parameters(), lr=config.lr)
+    optimizer = torch.optim.Adam(dmodel.parameters(), lr=config.lr, fused=True, capturable=config.trace) # only needed to pass the capture check of the profiling CUDA graph below
     train_data = config.get_data()[1]
 
-    result_times = []
-    strat_time = last_iter_time = time.time()
-    total_loss = 0
+    # iteration boundaries are timed with a ring of CUDA events, which are only read back when reporting
+    iter_events = [ torch.cuda.Event(enable_timing=True) for _ in range(config.avg_iter + 1) ]
+    result_times = np.zeros(config.avg_iter)
+    strat_time = time.time()
+    total_loss = torch.zeros((), device=local_rank) # accumulated on device, only read back when logging
+    reduce_buf = torch.empty((), device=local_rank)
 
     x, y = next(train_data)
     unscaled_sharding_lengths = [3858755112937, 3858755112937, 3858755112937, 3858755112937, 3858755112937, 3858755112937, 3858755112937, 3858755112937, 2149250936815, 2149250936815, 2149250936815, 2149250936815, 2149250936815, 2149250936815, 2149250936815, 2149250936815, 2149250936815, 2149250936815, 2149250936815, 2149250936815, 2149250936815, 2149250936815, 2149250936815, 2149250936815, 2149250936815, 2149250936815, 2149250936815, 2149250936815, 2149250936815]
@@ -34,34 +56,42 @@ def run(global_rank, local_rank):
     sharding_lengths = [ s / sum(unscaled_sharding_lengths) for s in unscaled_sharding_lengths]
     hap.sharding_round(x.shape[0], sharding_lengths)
     print(sharding_lengths, flush=True)
-    x = x.split(sharding_lengths, 0)[global_rank].cuda(local_rank)
-    y = y.split(sharding_lengths, 0)[global_rank].cuda(local_rank)
+    offsets = np.cumsum([0] + sharding_lengths) # slice out only the local shard instead of splitting into all of them
+    x = x[offsets[global_rank]:offsets[global_rank+1]].to(local_rank, non_blocking=True)
+    y = y[offsets[global_rank]:offsets[global_rank+1]].to(local_rank, non_blocking=True)
 
+    iter_events[0].record()
     for iter in range(config.run_iter):
         optimizer.zero_grad()
 
         loss = dmodel(x, y) * config.world_size # DDP averages the loss
 
-        aggregated_loss = loss.detach().clone()
-        dist.reduce(aggregated_loss, 0)
-        if global_rank == 0:
-            total_loss += aggregated_loss.cpu().numpy() / config.batch_size / config.seqlen
-            if iter % config.log_iter == 0:
-                print(f"loss (log ppl) {iter}: {total_loss / config.log_iter:.3f}, wall clock: {time.time() - strat_time:.3f}")
-                total_loss = 0
+        reduce_buf.copy_(loss.detach())
+        reduce_handle = dist.reduce(reduce_buf, 0, async_op=True)
         # dist.barrier(device_ids=[global_rank])
 
         loss.backward()
-        torch.nn.utils.clip_grad_norm_(dmodel.parameters(), 0.5)
+        clip_grad_norm_(dmodel.parameters(), 0.5)
         # torch.cuda.synchronize()
         optimizer.step()
         # dist.barrier()
+
+        reduce_handle.wait() # only makes the current stream wait for the reduction (reduce_buf is reused next iteration), the host is not blocked
+        if global_rank == 0:
+            total_loss += reduce_buf
+            if iter % config.log_iter == 0:
+                print(f"loss (log ppl) {iter}: {total_loss.item() / config.log_iter / config.batch_size / config.seqlen:.3f}, wall clock: {time.time() - strat_time:.3f}")
+                total_loss.zero_()
         if config.report_per_iter_time and local_rank == 0:
-            iter_duration = time.time() - last_iter_time
-            result_times.append(iter_duration)
-            last_iter_time += iter_duration
-            print("iter time: ", iter_duration)
-            print("avg±std:", np.mean(result_times[-config.avg_iter:]), np.std(result_times[-config.avg_iter:]), flush=True)
+            iter_events[(iter + 1) % len(iter_events)].record()
+            if (iter + 1) % config.log_iter == 0 or iter + 1 == config.run_iter:
+                iter_events[(iter + 1) % len(iter_events)].synchronize() # events complete in order, so waiting for the last one is enough
+                n = min(iter + 1, config.avg_iter)
+                for i in range(n): # result_times[0] is the latest iteration
+                    end = iter + 1 - i
+                    result_times[i] = iter_events[(end - 1) % len(iter_events)].elapsed_time(iter_events[end % len(iter_events)]) / 1000
+                print("iter time: ", result_times[0])
+                print("avg±std:", np.mean(result_times[:n]), np.std(result_times[:n]), flush=True)
 
     if not config.trace:
         return
@@ -69,6 +99,31 @@ def run(global_rank, local_rank):
     # x, y = next(train_data)
     # x = x.chunk(config.world_size, 0)[global_rank].cuda(local_rank)
     # y = y.chunk(config.world_size, 0)[global_rank].cuda(local_rank)
+
+    # A whole iteration (including DDP's gradient all-reduce and the update) is captured into a CUDA graph and replayed, so the
+    # profiled iterations are free of host-side launch overhead. x and y are already static: the same batch is used all along.
+    # DDP needs at least 11 eager iterations on a side stream before being captured. Autocast caching does not work with graphs.
+    # The autocast context is built once and re-entered; bf16 needs no loss scaling, fp16 is the fallback on pre-Ampere cards.
+    autocast = torch.autocast(device_type="cuda", dtype=torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16, cache_enabled=False) if config.fp16 else nullcontext()
+    side_stream = torch.cuda.Stream()
+    side_stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(side_stream):
+        for _ in range(11):
+            optimizer.zero_grad(set_to_none=True)
+            with autocast:
+                loss = dmodel(x, y)
+            loss.backward()
+            optimizer.step()
+    torch.cuda.current_stream().wait_stream(side_stream)
+
+    graph = torch.cuda.CUDAGraph()
+    optimizer.zero_grad(set_to_none=True) # so that the capture does not record an accumulation into the previous gradients (DDP points them back at its bucket views)
+    with torch.cuda.graph(graph):
+        with autocast:
+            loss = dmodel(x, y)
+        loss.backward()
+        optimizer.step()
+
     with profile(
         activities = [ProfilerActivity.CPU, ProfilerActivity.CUDA],
         # record_shapes = True,
@@ -76,14 +131,8 @@ def run(global_rank, local_rank):
         schedule = torch.profiler.schedule(wait=1, warmup=10, active=4)
     ) as prof:
         for _ in range(15):
-            with record_function("forward"):
-                with torch.autocast(device_type="cuda") if config.fp16 else nullcontext() :
-                    loss = dmodel(x, y)
-            with record_function("backward"):
-                loss.backward()
-                torch.cuda.synchronize()
-            with record_function("update"):
-                optimizer.step()
+            with record_function("iteration"):
+                graph.replay()
             dist.barrier()
             prof.step()
 
@@ -102,12 +151,11 @@ if __name__ == '__main__':
     os.environ['MASTER_ADDR'] = str(config.master_addr)
     os.environ['MASTER_PORT'] = str(config.master_port)
     os.environ['WORLD_SIZE'] = str(config.world_size)
+    for k, v in config.nccl_env.items():
+        os.environ.setdefault(k, str(v))
+    if config.trace:
+        os.environ['NCCL_ASYNC_ERROR_HANDLING'] = '0' # its watchdog queries NCCL work during capture, which CUDA graphs do not allow
 
     import torch.multiprocessing as mp
-    mp.set_start_method('spawn')
-
-    for local_rank, global_rank in enumerate(ranks):
-        mp.Process(target=run, args=(global_rank, local_rank)).start()
-
-    for p in mp.active_children():
-        p.join()
+    # unlike bare Processes, a worker that fails terminates the others and its exception is re-raised here instead of hanging
+    mp.spawn(run, args=(ranks,), nprocs=len(ranks), join=True, start_method='spawn')
@@ -8,6 +8,13 @@ import numpy as np
 # env["PATH"] = "/home/swzhang/miniconda3/envs/th19/bin:" + env["PATH"]
 # os.environ.update(env)
 
+import torch
+if hasattr(torch.cuda.memory, '_set_allocator_settings'): # PyTorch 2.1+; MoE routing changes allocation sizes every step and fragments the cache otherwise
+    torch.cuda.memory._set_allocator_settings("expandable_segments:True")
+
+for k, v in config.nccl_env.items():
+    os.environ.setdefault(k, str(v))
+
 import deepspeed
 deepspeed.init_distributed(timeout=datetime.timedelta(hours=2))
 # deepspeed.utils.groups.initialize(ep_size=config.world_size)
@@ -29,6 +36,12 @@ parser.add_argument('--local_rank',
 parser = deepspeed.add_config_arguments(parser)
 args = parser.parse_args()
 
+def add_layer_norm(x, residual, weight, bias, eps): # the parameters are passed as tensors, so all layers share one compiled kernel
+    return torch.nn.functional.layer_norm(x + residual, weight.shape, weight, bias, eps)
+
+if hasattr(torch, 'compile'): # PyTorch 2.0+. Fuses the residual add into the LayerNorm kernel, so x is read once instead of twice
+    add_layer_norm = torch.compile(add_layer_norm, dynamic=False)
+
 class Top2TransformerEncoderLayer(nn.Module):
     def __init__(self):
         super().__init__()
@@ -55,8 +68,8 @@ class Top2TransformerEncoderLayer(nn.Module):
         self.dropout = torch.nn.Dropout(config.dropout)
 
     def forward(self, x, src_mask = None):
-        x = self.norm1(x + self._sa_block(x, src_mask))
-        x = self.norm2(x + self.moe(x)[0])
+        x = add_layer_norm(x, self._sa_block(x, src_mask), self.norm1.weight, self.norm1.bias, self.norm1.eps)
+        x = add_layer_norm(x, self.moe(x)[0], self.norm2.weight, self.norm2.bias, self.norm2.eps)
         return x
 
     def _sa_block(self, x, attn_mask):
@@ -89,14 +102,20 @@ class SwitchTransformerEncoderLayer(nn.Module):
         self.dropout = torch.nn.Dropout(config.dropout)
 
     def forward(self, x, src_mask = None):
-        x = self.norm1(x + self._sa_block(x, src_mask))
-        x = self.norm2(x + self.moe(x)[0])
+        x = add_layer_norm(x, self._sa_block(x, src_mask), self.norm1.weight, self.norm1.bias, self.norm1.eps)
+        x = add_layer_norm(x, self.moe(x)[0], self.norm2.weight, self.norm2.bias, self.norm2.eps)
         return x
 
     def _sa_block(self, x, attn_mask):
         x = self.self_atten(x, x, x, attn_mask=attn_mask, need_weights=False)[0]
         return self.dropout(x)
 
+def DenseTransformerEncoderLayer():
+    layer = torch.nn.TransformerEncoderLayer(config.emsize, config.nheads, config.nhid, config.dropout, batch_first=True)
+    if hasattr(torch, 'compile'): # PyTorch 2.0+. Only the dense layers are compiled, the MoE layers are slower under torch.compile
+        layer = torch.compile(layer, mode='reduce-overhead', dynamic=False)
+    return layer
+
 class LogShape(torch.nn.Module):
     def __init__(self) -> None:
         super().__init__()
@@ -109,7 +128,7 @@ class TMoE(torch.nn.Module):
         super().__init__()
 
         self.layers = torch.nn.ModuleList([
-            torch.nn.TransformerEncoderLayer(config.emsize, config.nheads, config.nhid, config.dropout, batch_first=True)
+            DenseTransformerEncoderLayer()
             if i % 2 == 0 else
             SwitchTransformerEncoderLayer()
             for i in range(config.nlayers)
@@ -130,7 +149,7 @@ class RMoE(torch.nn.Module):
         self.register_buffer('src_mask', torch.triu(torch.full((config.seqlen, config.seqlen), float('-inf')), diagonal=1))
         self.encoder = torch.nn.Embedding(ntokens, config.emsize)
         self.layers = torch.nn.ModuleList([
-            torch.nn.TransformerEncoderLayer(config.emsize, config.nheads, config.nhid, config.dropout, batch_first=True)
+            DenseTransformerEncoderLayer()
             if i % 2 == 0 else
             Top2TransformerEncoderLayer()
             for i in range(config.nlayers)
@@ -157,7 +176,7 @@ class RSwitch(torch.nn.Module):
         self.register_buffer('src_mask', torch.triu(torch.full((config.seqlen, config.seqlen), float('-inf')), diagonal=1))
         self.encoder = torch.nn.Embedding(ntokens, config.emsize)
         self.layers = torch.nn.ModuleList([
-            torch.nn.TransformerEncoderLayer(config.emsize, config.nheads, config.nhid, config.dropout, batch_first=True)
+            DenseTransformerEncoderLayer()
             if i % 2 == 0 else
             SwitchTransformerEncoderLayer()
             for i in range(config.nlayers)
@@ -185,7 +204,7 @@ class VMoE(torch.nn.Module):
         self.pos_embed = torch.nn.Parameter(torch.zeros(1, config.seqlen + 1, config.emsize)) # seqlen patches + 1 cls token
 
         self.layers = torch.nn.ModuleList([
-            torch.nn.TransformerEncoderLayer(config.emsize, config.nheads, config.nhid, config.dropout, batch_first=True)
+            DenseTransformerEncoderLayer()
             if i % 2 == 0 else
             Top2TransformerEncoderLayer()
             for i in range(config.nlayers)
@@ -216,7 +235,7 @@ class VSwitch(torch.nn.Module):
         self.pos_embed = torch.nn.Parameter(torch.zeros(1, config.seqlen + 1, config.emsize)) # seqlen patches + 1 cls token
 
         self.layers = torch.nn.ModuleList([
-            torch.nn.TransformerEncoderLayer(config.emsize, config.nheads, config.nhid, config.dropout, batch_first=True)
+            DenseTransformerEncoderLayer()
             if i % 2 == 0 else
             SwitchTransformerEncoderLayer()
             for i in range(config.nlayers)
@@ -356,28 +375,45 @@ model_engine, optimizer, _, __ = deepspeed.initialize(
 
 global_rank = dist.get_rank()
 
+copy_stream = torch.cuda.Stream()
+
+def load_batch(): # starts copying the next batch on a side stream, so that it overlaps with the computation of the current one
+    x, y = next(train_data)
+    with torch.cuda.stream(copy_stream):
+        x = x.chunk(config.world_size, 0)[global_rank].to(model_engine.local_rank, non_blocking=True)
+        y = y.chunk(config.world_size, 0)[global_rank].to(model_engine.local_rank, non_blocking=True)
+    return x, y
+
+def wait_batch(batch):
+    torch.cuda.current_stream().wait_stream(copy_stream)
+    for t in batch: # allocated on copy_stream but consumed on the current stream
+        t.record_stream(torch.cuda.current_stream())
+    return batch
+
 result_times = []
 strat_time = last_iter_time = time.time()
 total_loss = 0
+reduce_buf = torch.empty((), device=model_engine.local_rank)
+next_batch = load_batch()
 for iter in range(config.run_iter):
-    x, y = next(train_data)
-    x = x.chunk(config.world_size, 0)[global_rank].cuda(model_engine.local_rank)
-    y = y.chunk(config.world_size, 0)[global_rank].cuda(model_engine.local_rank)
+    x, y = wait_batch(next_batch)
+    next_batch = load_batch()
 
     loss = model_engine(x, y)
-    aggregated_loss = loss.detach().clone()
-    dist.reduce(aggregated_loss, 0)
+    reduce_buf.copy_(loss.detach())
+    reduce_handle = dist.reduce(reduce_buf, 0, async_op=True) # overlaps with the backward
+
+    model_engine.backward(loss)
+    # torch.cuda.synchronize()
+    model_engine.step()
 
+    reduce_handle.wait() # only makes the current stream wait for the reduction, reduce_buf is reused next iteration
     if global_rank == 0:
-        total_loss += aggregated_loss.cpu().numpy() / config.batch_size / config.seqlen
+        total_loss += reduce_buf.cpu().numpy() / config.batch_size / config.seqlen
         if iter % config.log_iter == 0:
             print(f"loss (log ppl) {iter}: {total_loss / config.log_iter:.3f}, wall clock: {time.time() - strat_time:.3f}")
             total_loss = 0
 
-    model_engine.backward(loss)
-    # torch.cuda.synchronize()
-    model_engine.step()
-
     if config.report_per_iter_time and model_engine.local_rank == 0:
         iter_duration = time.time() - last_iter_time
         result_times.append(iter_duration)
@@ -390,9 +426,7 @@ if not config.trace:
 
 from torch.profiler import profile, record_function, ProfilerActivity
 
-x, y = next(train_data)
-x = x.chunk(config.world_size, 0)[global_rank].cuda(model_engine.local_rank)
-y = y.chunk(config.world_size, 0)[global_rank].cuda(model_engine.local_rank)
+x, y = wait_batch(next_batch)
 with profile(
     activities= [ProfilerActivity.CPU, ProfilerActivity.CUDA],
     schedule = torch.profiler.schedule(wait=1, warmup=10, active=4)
@@ -11,7 +11,9 @@ def eprint(*args, **kwargs):
     import sys
     print(*args, file=sys.stderr, **kwargs)
 
-def run(global_rank, local_rank):
+def run(local_rank, ranks):
+    global_rank = ranks[local_rank]
+    torch.cuda.set_device(local_rank) # otherwise pinning the input batches creates an extra context on cuda:0 in every process
     import hap
 
     import torch.distributed as dist
@@ -123,7 +125,6 @@ def run(global_rank, local_rank):
                 loss = dmodel(x, y)
             with record_function("backward"):
                 loss.backward()
-                torch.cuda.synchronize()
             with record_function("update"):
                 optimizer.step()
             dist.barrier()
@@ -144,12 +145,9 @@ if __name__ == '__main__':
     os.environ['MASTER_ADDR'] = str(config.master_addr)
     os.environ['MASTER_PORT'] = str(config.master_port)
     os.environ['WORLD_SIZE'] = str(config.world_size)
+    for k, v in config.nccl_env.items():
+        os.environ.setdefault(k, str(v))
 
     import torch.multiprocessing as mp
-    mp.set_start_method('spawn')
-
-    for local_rank, global_rank in enumerate(ranks):
-        mp.Process(target=run, args=(global_rank, local_rank)).start()
-
-    for p in mp.active_children():
-        p.join()
+    # unlike bare Processes, a worker that fails terminates the others and its exception is re-raised here instead of hanging
+    mp.spawn(run, args=(ranks,), nprocs=len(ranks), join=True, start_method='spawn')